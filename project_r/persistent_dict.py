@@ -1,83 +1,371 @@
 import json
 import logging
-from io import TextIOBase
+import math
+import mmap
+import os
+import threading
+from asyncio import Event, Lock, Task, get_running_loop, wait_for
+from io import SEEK_END, BufferedIOBase
 from pathlib import Path
 from typing import Any
 
-from project_r.decorators import ensure_file_is_open
-from project_r.rwlock import RWLock
+import orjson
+
+from project_r.exceptions import DatabaseClosedError
 
 __all__ = ["PersistentDict"]
 
+# The journal is compacted once it holds this many times more records than
+# there are live keys, as long as it has at least _COMPACTION_MIN_RECORDS.
+_COMPACTION_RATIO = 2
+_COMPACTION_MIN_RECORDS = 1024
+
+# Changes are written to the journal in batches, at most this many seconds
+# after the first unwritten change, or as soon as this many keys are pending
+_FLUSH_DELAY = 0.005
+_FLUSH_MAX_KEYS = 64
+
+# Non-string dict keys are accepted and stringified, as the stdlib json module does
+_DUMPS_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+
+
+def _dumps_record(record: dict) -> bytes:
+    return orjson.dumps(record, option=_DUMPS_OPTIONS)
+
+
+def _check_key(key):
+    # Keys are stored as JSON values, so only types that load back as an equal
+    # hashable key are allowed, the same ones the stdlib json module accepts
+    if key is not None and not isinstance(key, (str, int, float, bool)):
+        raise TypeError(
+            f"keys must be str, int, float, bool or None, not {type(key).__name__}"
+        )
+
+    # NaN and infinities are saved as null, so they'd load back as the None key
+    if isinstance(key, float) and not math.isfinite(key):
+        raise ValueError(f"float keys must be finite, not {key}")
+
 
 class PersistentDict:
     """
     Persistent async key-value storage.
+
+    The database file is an append-only journal with one JSON record per line:
+    {"k": key, "v": value} for a set and {"k": key, "d": 1} for a removal.
+    Replaying the journal rebuilds the dictionary, and the journal is compacted
+    down to one record per key when it accumulates too many stale records.
+    Databases in the older format, a single JSON dictionary, are migrated to
+    the journal format when loaded.
+
+    Values must be JSON serializable, and unlike with the stdlib json module
+    integers must fit in 64 bits. set() raises TypeError for values that
+    can't be stored. Float NaN and infinities in values are saved as null and
+    load back as None.
+
+    Changes are buffered in memory and written in the background shortly after
+    they're made. Use flush() to wait until they are on disk, closing the
+    database also writes any pending changes.
     """
 
-    def __init__(self, file: TextIOBase | Path) -> None:
+    def __init__(self, file: BufferedIOBase | Path) -> None:
         """
-        File can be a Path to a database file or a TextIOBase if you don't want to use a file,
-        such as using a StringIO object for a memory database.
+        File can be a Path to a database file or a BufferedIOBase if you don't want to use a file,
+        such as using a BytesIO object for a memory database.
         """
 
-        self._rwlock = RWLock()
-        self._file: TextIOBase = self._get_file_object(file)
+        self._write_lock = Lock()
+        # Held by whichever thread is writing to self._file, so close() can't
+        # interleave with a write running in a worker thread
+        self._file_lock = threading.Lock()
+        self._path: Path | None = file if isinstance(file, Path) else None
+        self._file: BufferedIOBase = self._get_file_object(file)
+        self._data: dict = {}
+        self._journal_records = 0
+        # Encoded records of the keys changed since the last flush
+        self._dirty: dict[Any, bytes] = {}
+        self._in_flight: list[bytes] = []
+        self._flush_task: Task | None = None
+        self._batch_full = Event()
 
-        try:
-            self._data: dict = json.load(self._file)
-        except json.JSONDecodeError:
-            # File is not empty, database exists but failed to load
-            if self._file.read():
+        if self._path is not None and os.fstat(self._file.fileno()).st_size:
+            # Parse records straight from the page cache instead of copying
+            # the whole file into memory first
+            with mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                migrate, journal_end = self._load(mm)
+                journal_size = len(mm)
+        else:
+            journal = self._file.read()
+            migrate, journal_end = self._load(journal)
+            journal_size = len(journal)
+
+        self._is_open = True
+
+        if migrate:
+            logging.info("Persistent storage migrating database to journal format")
+            self._compact(list(self._data.items()))
+        elif journal_end < journal_size:
+            # Drop the torn record so new records aren't appended onto it
+            self._file.truncate(journal_end)
+
+    def _load(self, journal: bytes | mmap.mmap) -> tuple[bool, int]:
+        """
+        Load the database contents, returning whether they are in the older
+        single dictionary format and need migrating, and the length of the
+        valid journal records.
+        """
+        if journal[:1] == b"{" and journal[:5] != b'{"k":':
+            try:
+                # The stdlib parser keeps integers of any size exact
+                data = json.loads(bytes(journal))
+            except json.JSONDecodeError:
                 raise Exception("Failed to load database.")
 
-            # File is empty so it's a new database, make an empty dict
-            self._data: dict = {}
+            assert type(data) is dict, "Database file is not a dictionary"
+
+            # Check the data survives the journal format before touching the
+            # file, the stdlib allowed integers over 64 bits and NaN/Infinity
+            try:
+                json.dumps(data, allow_nan=False)
+                orjson.dumps(data, option=_DUMPS_OPTIONS)
+            except (TypeError, ValueError) as e:
+                raise Exception(
+                    f"Failed to migrate database to journal format: {e}"
+                ) from e
+
+            self._data = data
+            return True, 0
+
+        return False, self._replay_journal(journal)
+
+    def _replay_journal(self, journal: bytes | mmap.mmap) -> int:
+        with memoryview(journal) as view:
+            start = 0
+            while start < len(journal):
+                end = journal.find(b"\n", start)
+                if end == -1:
+                    # Records are always written along with their newline, so
+                    # a final line without one was torn by a crash mid-write
+                    logging.warning(
+                        "Persistent storage ignoring incomplete last record"
+                    )
+                    return start
 
-        assert type(self._data) is dict, "Database file is not a dictionary"
+                with view[start:end] as line:
+                    start = end + 1
+                    if not line:
+                        continue
 
-    def _get_file_object(self, file) -> TextIOBase:
-        if type(file) is Path:
-            return open(file, "r+" if file.is_file() else "w+")
-        elif isinstance(file, TextIOBase):
+                    try:
+                        record = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        raise Exception("Failed to load database.")
+
+                assert type(record) is dict, "Database record is not a dictionary"
+                self._apply_record(record)
+                self._journal_records += 1
+
+        return len(journal)
+
+    def _get_file_object(self, file) -> BufferedIOBase:
+        if isinstance(file, Path):
+            return open(file, "rb+" if file.is_file() else "wb+")
+        elif isinstance(file, BufferedIOBase):
             return file
         else:
             raise Exception("Invalid file type")
 
-    @ensure_file_is_open
-    async def get(self, key) -> Any:
-        async with self._rwlock.reader_locked():
-            result = self._data.get(key, None)
-            return result
+    def _apply_record(self, record: dict):
+        if record.get("d"):
+            self._data.pop(record["k"], None)
+        else:
+            self._data[record["k"]] = record["v"]
 
-    @ensure_file_is_open
-    async def set(self, key, value):
-        async with self._rwlock.writer_locked():
-            logging.debug(f"Persistent storage set {key} to {value}")
+    def _mark_dirty(self, key, record: bytes):
+        self._dirty[key] = record
+        if self._flush_task is None:
+            self._flush_task = get_running_loop().create_task(self._flush_later())
+        elif len(self._dirty) >= _FLUSH_MAX_KEYS:
+            self._batch_full.set()
 
-            self._data[key] = value
+    async def _flush_later(self):
+        try:
+            await wait_for(self._batch_full.wait(), _FLUSH_DELAY)
+        except TimeoutError:
+            pass
+        self._batch_full.clear()
+        self._flush_task = None
 
-            self._file.truncate(0)
-            self._file.seek(0)
-            json.dump(self._data, self._file, sort_keys=True, indent=4)
+        try:
+            await self.flush()
+        except DatabaseClosedError:
+            pass
+        except Exception:
+            logging.exception("Persistent storage failed to flush")
+
+    def _take_dirty_records(self) -> list[bytes]:
+        dirty, self._dirty = self._dirty, {}
+        return list(dirty.values())
+
+    def _write_in_flight(self):
+        with self._file_lock:
+            # close() writes the in flight records itself if it gets here first
+            if not self._is_open:
+                return
+            if self._file.closed:
+                raise DatabaseClosedError()
+
+            self._file.seek(0, SEEK_END)
+            self._file.writelines(self._in_flight)
             self._file.flush()
+            if self._path is not None:
+                os.fsync(self._file.fileno())
+            # Only cleared once written, a failed write is retried by the next flush
+            self._journal_records += len(self._in_flight)
+            self._in_flight = []
+
+    def _compact(self, items: list[tuple]):
+        """
+        Rewrite the journal with a single set record per live key.
+        """
+        with self._file_lock:
+            if not self._is_open:
+                return
+
+            logging.debug(
+                "Persistent storage compacting %d records to %d",
+                self._journal_records,
+                len(items),
+            )
+
+            if self._path is None:
+                self._file.truncate(0)
+                self._file.seek(0)
+                self._write_live_records(self._file, items)
+            else:
+                # Write to a temporary file and atomically swap it in, so a crash
+                # mid-compaction never leaves a truncated database behind
+                tmp_path = self._path.with_name(self._path.name + ".tmp")
+                try:
+                    with open(tmp_path, "wb") as tmp_file:
+                        self._write_live_records(tmp_file, items)
+                        os.fsync(tmp_file.fileno())
+
+                    # Windows can't replace a file that is still open
+                    self._file.close()
+                    try:
+                        os.replace(tmp_path, self._path)
+                    finally:
+                        self._file = open(self._path, "rb+")
+                except BaseException:
+                    tmp_path.unlink(missing_ok=True)
+                    raise
+
+            self._journal_records = len(items)
+
+    def _write_live_records(self, file: BufferedIOBase, items: list[tuple]):
+        for key, value in items:
+            file.write(_dumps_record({"k": key, "v": value}))
+        file.flush()
+
+    async def get(self, key) -> Any:
+        if not self._is_open:
+            raise DatabaseClosedError()
+
+        # Writers update self._data without awaiting in between, so readers
+        # never observe a partial update and don't need to take the lock
+        return self._data.get(key, None)
+
+    async def set(self, key, value):
+        if not self._is_open:
+            raise DatabaseClosedError()
+
+        _check_key(key)
+        logging.debug("Persistent storage set %s to %s", key, value)
+        # Encode right away so values that can't be stored raise here, not
+        # in the background flush
+        record = _dumps_record({"k": key, "v": value})
+        self._data[key] = value
+        self._mark_dirty(key, record)
 
-    @ensure_file_is_open
     async def remove(self, key):
-        async with self._rwlock.writer_locked():
-            logging.debug(f"Persistent storage removed {key}")
-            self._data.pop(key)
+        if not self._is_open:
+            raise DatabaseClosedError()
 
-            self._file.truncate(0)
-            self._file.seek(0)
-            json.dump(self._data, self._file, sort_keys=True, indent=4)
-            self._file.flush()
+        _check_key(key)
+        logging.debug("Persistent storage removed %s", key)
+        self._data.pop(key)
+        self._mark_dirty(key, _dumps_record({"k": key, "d": 1}))
+
+    async def flush(self):
+        """
+        Write all pending changes to the database file, and fsync it if the
+        database is backed by a Path.
+
+        File I/O runs in a worker thread so the event loop isn't blocked.
+        """
+        if not self._is_open:
+            raise DatabaseClosedError()
+
+        async with self._write_lock:
+            if not self._dirty and not self._in_flight:
+                return
+
+            loop = get_running_loop()
+            # A worker from a cancelled flush may still be writing the records
+            # in flight, so add to them under its lock instead of replacing them
+            with self._file_lock:
+                self._in_flight += self._take_dirty_records()
+            try:
+                await loop.run_in_executor(None, self._write_in_flight)
+            except DatabaseClosedError:
+                # The file was closed from outside, close the database with it
+                self.close()
+                raise
+
+            if self._journal_records > max(
+                _COMPACTION_MIN_RECORDS, _COMPACTION_RATIO * len(self._data)
+            ):
+                # Snapshot the items, self._data may change while the worker runs
+                items = list(self._data.items())
+                await loop.run_in_executor(None, self._compact, items)
 
     def close(self):
-        if not self._file.closed:
+        if not getattr(self, "_is_open", False):
+            # Already closed, or __init__ failed, possibly after opening the file
+            if (file := getattr(self, "_file", None)) is not None:
+                file.close()
+            return
+
+        with self._file_lock:
+            # The file may have been closed from outside, in which case the
+            # pending records can't be written anymore
+            records = self._in_flight + self._take_dirty_records()
+            if records and self._file.closed:
+                logging.warning(
+                    "Persistent storage file was closed, dropping %d pending changes",
+                    len(records),
+                )
+            elif records:
+                self._file.seek(0, SEEK_END)
+                self._file.writelines(records)
+                self._file.flush()
+                if self._path is not None:
+                    os.fsync(self._file.fileno())
+            self._in_flight = []
+
             self._file.close()
+            self._is_open = False
             self._data = {}
 
+        # Only after writing, cancelling raises if the task's loop is closed
+        if self._flush_task is not None:
+            if not self._flush_task.done():
+                try:
+                    self._flush_task.cancel()
+                except RuntimeError:
+                    pass
+            self._flush_task = None
+
     def __del__(self):
         """
         Ensure the file is closed when the object is destroyed.
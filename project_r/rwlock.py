@@ -1,4 +1,4 @@
-from asyncio import Lock
+from asyncio import Event, Lock
 from typing import AsyncContextManager
 
 
@@ -29,35 +29,80 @@ class ReadLockContextManager:
 class RWLock:
     """
     Lock implemented based on wikipedia's pseucode for a Readers–writer lock
+
+    The counter of readers doesn't need its own lock since asyncio runs every
+    coroutine on a single thread. Only one reader acquires the global lock,
+    other readers wait on an event for it to succeed instead.
+
+    Writers are preferred: once a writer is waiting, new readers wait for it to
+    get the lock, so a steady stream of readers can't starve writers.
     """
 
     def __init__(self):
-        self._r = Lock()
         self._g = Lock()
         self._b = 0
+        self._readers_locked = Event()
+        self._reader_acquiring = False
+        self._writers_waiting = 0
+        self._no_writers_waiting = Event()
+        self._no_writers_waiting.set()
+        # The context managers hold no per-use state, so one of each is shared
+        # by every caller instead of being allocated on each lock
+        self._write_lock_context = WriteLockContextManager(self)
+        self._read_lock_context = ReadLockContextManager(self)
 
     async def _begin_read(self):
-        await self._r.acquire()
+        while self._writers_waiting:
+            await self._no_writers_waiting.wait()
+
         self._b += 1
-        if self._b == 1:
-            await self._g.acquire()
-        self._r.release()
+        try:
+            while not self._readers_locked.is_set():
+                if self._reader_acquiring:
+                    await self._readers_locked.wait()
+                    continue
+
+                self._reader_acquiring = True
+                try:
+                    await self._g.acquire()
+                finally:
+                    self._reader_acquiring = False
+                self._readers_locked.set()
+        except BaseException:
+            if self._readers_locked.is_set():
+                self._release_read()
+            else:
+                # Wake the waiting readers so one of them takes over acquiring
+                # the global lock if this reader was the one doing it
+                self._b -= 1
+                self._readers_locked.set()
+                self._readers_locked.clear()
+            raise
 
     async def _end_read(self):
-        await self._r.acquire()
+        self._release_read()
+
+    def _release_read(self):
         self._b -= 1
         if self._b == 0:
+            self._readers_locked.clear()
             self._g.release()
-        self._r.release()
 
     async def _begin_write(self):
-        await self._g.acquire()
+        self._writers_waiting += 1
+        self._no_writers_waiting.clear()
+        try:
+            await self._g.acquire()
+        finally:
+            self._writers_waiting -= 1
+            if not self._writers_waiting:
+                self._no_writers_waiting.set()
 
     async def _end_write(self):
         self._g.release()
 
     def writer_locked(self) -> AsyncContextManager[WriteLockContextManager]:
-        return WriteLockContextManager(self)
+        return self._write_lock_context
 
     def reader_locked(self) -> AsyncContextManager[ReadLockContextManager]:
-        return ReadLockContextManager(self)
+        return self._read_lock_context
@@ -1,12 +1,18 @@
+import asyncio
+import gc
+import time
 import unittest
-from io import StringIO
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
 
 from project_r import DatabaseClosedError, PersistentDict
 
 
 class PersistentDictBasicTestCase(unittest.IsolatedAsyncioTestCase):
     async def asyncSetUp(self):
-        self.buffer = StringIO("")
+        self.buffer = BytesIO()
         self.storage = PersistentDict(self.buffer)
 
     async def test_get_set_remove(self):
@@ -27,6 +33,225 @@ class PersistentDictBasicTestCase(unittest.IsolatedAsyncioTestCase):
         with self.assertRaises(DatabaseClosedError):
             await self.storage.remove("asd")
 
+    async def test_close_is_idempotent(self):
+        await self.storage.set("asd", "asd")
+        self.storage.close()
+        self.storage.close()
+
+        await asyncio.sleep(0.1)
+        self.assertTrue(self.buffer.closed)
+
+    async def test_close_after_file_closed(self):
+        await self.storage.set("asd", "asd")
+        self.buffer.close()
+        self.storage.close()
+
+        with self.assertRaises(DatabaseClosedError):
+            await self.storage.get("asd")
+
+    async def test_flush_after_file_closed(self):
+        await self.storage.set("asd", "asd")
+        self.buffer.close()
+
+        with self.assertRaises(DatabaseClosedError):
+            await self.storage.flush()
+
+        with self.assertRaises(DatabaseClosedError):
+            await self.storage.set("asd", "asd")
+
+    async def test_close_after_failed_init(self):
+        PersistentDict.__new__(PersistentDict).close()
+
+        buffer = BytesIO(b'{"k":"asd",}\n')
+        with self.assertRaises(Exception):
+            PersistentDict(buffer)
+        gc.collect()
+        self.assertTrue(buffer.closed)
+
+    async def test_reload_replays_journal(self):
+        await self.storage.set("asd", {"a": 1})
+        await self.storage.set("qwe", 1)
+        await self.storage.set("qwe", 2)
+        await self.storage.remove("asd")
+        await self.storage.flush()
+
+        storage = PersistentDict(BytesIO(self.buffer.getvalue()))
+        self.assertIs(await storage.get("asd"), None)
+        self.assertEqual(await storage.get("qwe"), 2)
+
+    async def test_unsupported_key_type(self):
+        with self.assertRaises(TypeError):
+            await self.storage.set((1, 2), "asd")
+
+        with self.assertRaises(TypeError):
+            await self.storage.remove((1, 2))
+
+        with self.assertRaises(ValueError):
+            await self.storage.set(float("inf"), "asd")
+
+    async def test_non_finite_float_value_is_saved_as_null(self):
+        await self.storage.set("asd", float("inf"))
+        await self.storage.flush()
+
+        storage = PersistentDict(BytesIO(self.buffer.getvalue()))
+        self.assertIs(await storage.get("asd"), None)
+
+    async def test_unsupported_value_raises_without_losing_writes(self):
+        await self.storage.set("asd", 1)
+        with self.assertRaises(TypeError):
+            await self.storage.set("qwe", object())
+        with self.assertRaises(TypeError):
+            await self.storage.set("qwe", 2**70)
+        await self.storage.flush()
+
+        storage = PersistentDict(BytesIO(self.buffer.getvalue()))
+        self.assertEqual(await storage.get("asd"), 1)
+        self.assertIs(await storage.get("qwe"), None)
+
+    async def test_cancelled_flush_keeps_records(self):
+        write_in_flight = self.storage._write_in_flight
+
+        def slow_write_in_flight():
+            time.sleep(0.05)
+            write_in_flight()
+
+        self.storage._write_in_flight = slow_write_in_flight
+        await self.storage.set("asd", 1)
+        with self.assertRaises(TimeoutError):
+            await asyncio.wait_for(self.storage.flush(), 0.01)
+
+        await self.storage.set("qwe", 2)
+        await self.storage.flush()
+
+        storage = PersistentDict(BytesIO(self.buffer.getvalue()))
+        self.assertEqual(await storage.get("asd"), 1)
+        self.assertEqual(await storage.get("qwe"), 2)
+
+    async def test_torn_last_record_is_ignored(self):
+        buffer = BytesIO(b'{"k":"asd","v":1}\n{"k":"qwe","v":')
+        storage = PersistentDict(buffer)
+        self.assertEqual(await storage.get("asd"), 1)
+        self.assertIs(await storage.get("qwe"), None)
+
+        await storage.set("qwe", 2)
+        await storage.flush()
+        storage = PersistentDict(BytesIO(buffer.getvalue()))
+        self.assertEqual(await storage.get("qwe"), 2)
+
+    async def test_legacy_database_is_migrated(self):
+        buffer = BytesIO(b'{\n    "asd": 1\n}')
+        storage = PersistentDict(buffer)
+        self.assertEqual(await storage.get("asd"), 1)
+
+        await storage.set("qwe", 1)
+        await storage.flush()
+        storage = PersistentDict(BytesIO(buffer.getvalue()))
+        self.assertEqual(await storage.get("qwe"), 1)
+
+    async def test_journal_compaction(self):
+        for i in range(2000):
+            await self.storage.set("asd", i)
+            await self.storage.flush()
+
+        self.assertLess(len(self.buffer.getvalue().splitlines()), 2000)
+
+        storage = PersistentDict(BytesIO(self.buffer.getvalue()))
+        self.assertEqual(await storage.get("asd"), 1999)
+
+    async def test_writes_are_batched(self):
+        for i in range(100):
+            await self.storage.set("asd", i)
+        await self.storage.set("qwe", "qwe")
+        self.assertEqual(self.buffer.getvalue(), b"")
+
+        await asyncio.sleep(0.1)
+        self.assertEqual(len(self.buffer.getvalue().splitlines()), 2)
+
+    async def test_full_batch_is_flushed_early(self):
+        with patch("project_r.persistent_dict._FLUSH_DELAY", 60):
+            for i in range(63):
+                await self.storage.set(i, i)
+            await asyncio.sleep(0.1)
+            self.assertEqual(self.buffer.getvalue(), b"")
+
+            await self.storage.set(63, 63)
+            await asyncio.sleep(0.1)
+            self.assertEqual(len(self.buffer.getvalue().splitlines()), 64)
+
+
+class PersistentDictFileTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = Path(self.directory.name) / "db.json"
+        self.storage = PersistentDict(self.path)
+
+    async def asyncTearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    async def test_legacy_database_that_cant_be_migrated(self):
+        self.storage.close()
+        for value in ("2361183241434822606848", "NaN"):
+            contents = f'{{\n    "asd": {value}\n}}'
+            self.path.write_text(contents)
+
+            with self.assertRaisesRegex(Exception, "Failed to migrate database"):
+                PersistentDict(self.path)
+            self.assertEqual(self.path.read_text(), contents)
+            self.assertEqual(list(Path(self.directory.name).iterdir()), [self.path])
+
+    async def test_journal_compaction(self):
+        for i in range(2000):
+            await self.storage.set("asd", i)
+            await self.storage.flush()
+        await self.storage.set("qwe", "qwe")
+        await self.storage.flush()
+
+        self.assertLess(len(self.path.read_text().splitlines()), 2000)
+        self.assertEqual(list(Path(self.directory.name).iterdir()), [self.path])
+
+        self.storage.close()
+        self.storage = PersistentDict(self.path)
+        self.assertEqual(await self.storage.get("asd"), 1999)
+        self.assertEqual(await self.storage.get("qwe"), "qwe")
+
+    async def test_failed_compaction_keeps_database(self):
+        with patch("os.replace", side_effect=OSError):
+            with self.assertRaises(OSError):
+                for i in range(2000):
+                    await self.storage.set("asd", i)
+                    await self.storage.flush()
+
+        self.assertEqual(list(Path(self.directory.name).iterdir()), [self.path])
+        await self.storage.set("qwe", "qwe")
+        await self.storage.flush()
+
+        self.storage.close()
+        self.storage = PersistentDict(self.path)
+        self.assertEqual(await self.storage.get("asd"), i)
+        self.assertEqual(await self.storage.get("qwe"), "qwe")
+
+    async def test_close_writes_pending_changes(self):
+        await self.storage.set("asd", "asd")
+        self.storage.close()
+
+        self.storage = PersistentDict(self.path)
+        self.assertEqual(await self.storage.get("asd"), "asd")
+
+
+class PersistentDictEventLoopTestCase(unittest.TestCase):
+    def test_close_after_event_loop_closed(self):
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / "db.json"
+            storage = PersistentDict(path)
+
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(storage.set("asd", "asd"))
+            loop.close()
+
+            storage.close()
+            self.assertEqual(path.read_bytes(), b'{"k":"asd","v":"asd"}\n')
+
 
 if __name__ == "__main__":
     unittest.main()
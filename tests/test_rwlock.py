@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+
+from project_r.rwlock import RWLock
+
+
+class RWLockTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.lock = RWLock()
+        self.events = []
+
+    async def read(self, name):
+        async with self.lock.reader_locked():
+            self.events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            self.events.append(f"{name} end")
+
+    async def write(self, name):
+        async with self.lock.writer_locked():
+            self.events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            self.events.append(f"{name} end")
+
+    async def assert_writer_can_lock(self):
+        await asyncio.wait_for(self.write("w2"), 1)
+        self.assertEqual(self.events[-2:], ["w2 start", "w2 end"])
+
+    async def test_readers_share_the_lock(self):
+        await asyncio.gather(self.read("r1"), self.read("r2"))
+        self.assertEqual(self.events, ["r1 start", "r2 start", "r1 end", "r2 end"])
+
+    async def test_readers_wait_for_writer(self):
+        await asyncio.gather(self.write("w"), self.read("r1"), self.read("r2"))
+        self.assertEqual(
+            self.events,
+            ["w start", "w end", "r1 start", "r2 start", "r1 end", "r2 end"],
+        )
+
+    async def test_writer_waits_for_readers(self):
+        await asyncio.gather(self.read("r"), self.write("w"))
+        self.assertEqual(self.events, ["r start", "r end", "w start", "w end"])
+
+    async def test_waiting_writer_goes_before_new_readers(self):
+        async def read_later():
+            await asyncio.sleep(0.005)
+            await self.read("r2")
+
+        await asyncio.gather(self.read("r1"), self.write("w"), read_later())
+        self.assertEqual(
+            self.events,
+            ["r1 start", "r1 end", "w start", "w end", "r2 start", "r2 end"],
+        )
+
+    async def test_cancelled_waiting_reader(self):
+        writer = asyncio.create_task(self.write("w"))
+        await asyncio.sleep(0)
+        readers = [asyncio.create_task(self.read(f"r{i}")) for i in (1, 2)]
+        await asyncio.sleep(0)
+        readers[1].cancel()
+
+        await asyncio.wait_for(
+            asyncio.gather(writer, readers[0], return_exceptions=True), 1
+        )
+        self.assertEqual(self.events, ["w start", "w end", "r1 start", "r1 end"])
+        await self.assert_writer_can_lock()
+
+    async def test_cancelled_acquiring_reader(self):
+        writer = asyncio.create_task(self.write("w"))
+        await asyncio.sleep(0)
+        readers = [asyncio.create_task(self.read(f"r{i}")) for i in (1, 2)]
+        await asyncio.sleep(0)
+        readers[0].cancel()
+
+        await asyncio.wait_for(
+            asyncio.gather(writer, readers[1], return_exceptions=True), 1
+        )
+        self.assertEqual(self.events, ["w start", "w end", "r2 start", "r2 end"])
+        await self.assert_writer_can_lock()
+
+
+if __name__ == "__main__":
+    unittest.main()